@@ -7,6 +7,9 @@ import itertools
 import random
 import argparse
 import json
+import math
+import collections
+import concurrent.futures
 
 #
 # Example Usages:
@@ -32,6 +35,8 @@ import json
 #         --lock 65,66          Lock tiles 65 and 66 in their current positions
 #         --require 40,42       Require tiles 40 and 42 to be part of map
 #         --exclude 44,61       Exclude tiles 44 and 61 from the map
+#         --jobs 4              Search permutations with 4 worker processes
+#         --temperature 5.0     Starting simulated annealing temperature (0 to only accept improvements)
 #
 # Definitions:
 #   home index - Index number of the home system (between 0 and n-1 for n players)
@@ -119,6 +124,11 @@ COORD_TO_KEEGAN = {}
 #
 KEEGAN_ADJACENT = []
 
+#
+# Hex distance between each pair of keegan tiles
+#
+DIST_MATRIX = []
+
 #
 # Coordinate offsets for neighbors of a hex tile starting one hex above and proceeding clockwise.
 #
@@ -189,14 +199,39 @@ TILES={}
 HOME_TILES=[]
 NONHOME_TILES=[]  
 
+#
+# Flat per-tile attribute tables indexed by tile index (once loaded).  These mirror
+# fields in TILES and are used by the optimization loop instead of the TILES dicts.
+#
+TILE_RESOURCE=[]        # Total resource
+TILE_INFLUENCE=[]       # Total influence
+TILE_EFF_RESOURCE=[]    # Effective resource
+TILE_EFF_INFLUENCE=[]   # Effective influence
+TILE_EFF_BOTH=[]        # Total of r=i planets
+TILE_PLANET_SYSTEM=[]   # True if the tile has planets
+TILE_SKIP=[]            # Tech skip ID of the tile (0 for none)
+TILE_ANOMALY=[]         # Anomaly ID of the tile (0 for none)
+TILE_WORM=[]            # Wormhole ID of the tile (0 for none)
+TILE_LEGEND=[]          # True if the tile has a legendary planet
+TILE_HOME=[]            # True if the tile is a home system (tile index 0 is a generic home)
+
+#
+# Integer IDs for tech skip, anomaly and wormhole strings (once loaded) so the optimization
+# loop compares integers instead of strings.  ID 0 means "none", and the NAMES lists map an
+# ID back to its string for printing.
+#
+SKIP_IDS={}
+SKIP_NAMES=[None]
+ANOMALY_IDS={}
+ANOMALY_NAMES=[None]
+WORM_IDS={}
+WORM_NAMES=[None]
+
 #
 # Return true if this is a home tile
 #
 def is_home(tile_index):
-    if tile_index == 0:
-        return True
-    else:
-        return TILES[tile_index]['home'] != None
+    return TILE_HOME[tile_index]
     
 #
 # Class representing statistics for a class of tiles around a home system (e.g., 1-hop,
@@ -209,6 +244,14 @@ class HomeStats:
     def __init__(self,hop,sub_category=None):
         self.hop = hop
         self.sub_category = sub_category
+
+        #
+        # Weight vector for score(), which only depends on the hop count
+        #
+        self.score_weights = (WEIGHTS.SCORE_EFF_RESOURCE,WEIGHTS.SCORE_RESOURCE,
+                              WEIGHTS.SCORE_EFF_INFLUENCE,WEIGHTS.SCORE_INFLUENCE,
+                              WEIGHTS.SCORE_SKIPS, (WEIGHTS.SCORE_ADJ_WORM if hop == 1 else WEIGHTS.SCORE_HOP2_WORM))
+
         self.reset()
 
     #
@@ -224,6 +267,7 @@ class HomeStats:
         self.worms = 0                  # Number of wormholes
         self.anomalies = 0              # Number of anomalies
         self.planet_systems = 0         # Number of tiles with planets
+        self.cached_score = None        # Result of score(), or None if it must be recomputed
 
     #
     # Add in statistics from another statistics object (+=)
@@ -238,6 +282,7 @@ class HomeStats:
         self.worms += rhs.worms
         self.anomalies += rhs.anomalies
         self.planet_systems += rhs.planet_systems
+        self.cached_score = None
         return self
 
     #
@@ -247,72 +292,77 @@ class HomeStats:
         print("  Hop-{}{}: r={}  i={}  er={}  ei={}  eb={}  ps={}  skips={}  worms={}   anom={}".format(
             self.hop,(" ("+self.sub_category+")" if self.sub_category else ""),
             self.resource,self.influence,self.eff_resource,self.eff_influence,self.eff_both,
-            self.planet_systems, self.skips,self.worms,self.anomalies))
+            self.planet_systems, [SKIP_NAMES[skip] for skip in self.skips],self.worms,self.anomalies))
 
     #
-    # Update the statistics from a list of tile_indices.  "tile_indices" is a list of
-    # keegan indices of board locations, and "board" is a list of tile numbers specifying
-    # the board that is being used.
+    # Accumulate statistics for a tile (by tile index) to this class
     #
-    def update(self,tile_indices,board):
-        self.reset()
-        for i in range(len(tile_indices)):
-            tile_index = board[tile_indices[i]]
-            if not is_home(tile_index):
-                self.add_tile(TILES[tile_index])
+    def add_tile(self,tile_index):
+        self.resource += TILE_RESOURCE[tile_index]
+        self.influence += TILE_INFLUENCE[tile_index]
+        self.eff_resource += TILE_EFF_RESOURCE[tile_index]
+        self.eff_influence += TILE_EFF_INFLUENCE[tile_index]
+        self.eff_both += TILE_EFF_BOTH[tile_index]
+
+        self.planet_systems += TILE_PLANET_SYSTEM[tile_index]
+        self.worms += (TILE_WORM[tile_index] != 0)
+        self.anomalies += (TILE_ANOMALY[tile_index] != 0)
+
+        if TILE_SKIP[tile_index]:
+            self.skips += [TILE_SKIP[tile_index]]
+
+        self.cached_score = None
 
     #
-    # Accumulate statistics for a tile to this class
+    # Remove statistics for a tile (by tile index) from this class (inverse of add_tile)
     #
-    def add_tile(self,tile):
-        for planet in tile['planets']:
-            resource = int(planet['resource'])
-            influence = int(planet['influence'])
-            self.resource += resource
-            self.influence += influence
+    def sub_tile(self,tile_index):
+        self.resource -= TILE_RESOURCE[tile_index]
+        self.influence -= TILE_INFLUENCE[tile_index]
+        self.eff_resource -= TILE_EFF_RESOURCE[tile_index]
+        self.eff_influence -= TILE_EFF_INFLUENCE[tile_index]
+        self.eff_both -= TILE_EFF_BOTH[tile_index]
 
-            if resource > influence:
-                self.eff_resource += resource
-            elif resource < influence:
-                self.eff_influence += influence
-            else:
-                self.eff_both += resource
+        self.planet_systems -= TILE_PLANET_SYSTEM[tile_index]
+        self.worms -= (TILE_WORM[tile_index] != 0)
+        self.anomalies -= (TILE_ANOMALY[tile_index] != 0)
 
-        self.planet_systems += (tile['resource']+tile['influence']) > 0
-        self.worms += (tile['worm'] != None)
-        self.anomalies += (tile['anomaly'] != None)
+        if TILE_SKIP[tile_index]:
+            self.skips.remove(TILE_SKIP[tile_index])
 
-        if tile['skip']:
-            self.skips += [tile['skip']]
+        self.cached_score = None
 
     #
     # Return a score for the this statistic class 
     #
     def score(self):
-        w = [WEIGHTS.SCORE_EFF_RESOURCE,WEIGHTS.SCORE_RESOURCE,
-             WEIGHTS.SCORE_EFF_INFLUENCE,WEIGHTS.SCORE_INFLUENCE,
-             WEIGHTS.SCORE_SKIPS, (WEIGHTS.SCORE_ADJ_WORM if self.hop == 1 else WEIGHTS.SCORE_HOP2_WORM)]
- 
-        v = [self.eff_resource+self.eff_both,self.resource,self.eff_influence,self.resource,len(self.skips),self.worms]
-
         #
-        # Base score is dot product of weight vector and value vector.  Currently the effective "both"
-        # class is folded into resource for now.
+        # The score is cached until the statistics change
         #
-        _score = sum(elem[0] * elem[1] for elem in zip(w,v))
+        if self.cached_score is None:
+            w = self.score_weights
 
-        #
-        # Impose large penalties for being outside min/max number of systems /w planets
-        # next to home system.
-        #
-        if self.hop == 1:
-            if self.planet_systems > WEIGHTS.SCORE_MAX_HOP1_PLANET_SYS:
-                _score += -100
-            if self.planet_systems < WEIGHTS.SCORE_MIN_HOP1_PLANET_SYS:
-                _score += -100
+            #
+            # Base score is dot product of weight vector and value vector.  Currently the effective "both"
+            # class is folded into resource for now.
+            #
+            _score = (w[0]*(self.eff_resource+self.eff_both) + w[1]*self.resource + w[2]*self.eff_influence +
+                      w[3]*self.resource + w[4]*len(self.skips) + w[5]*self.worms)
+
+            #
+            # Impose large penalties for being outside min/max number of systems /w planets
+            # next to home system.
+            #
+            if self.hop == 1:
+                if self.planet_systems > WEIGHTS.SCORE_MAX_HOP1_PLANET_SYS:
+                    _score += -100
+                if self.planet_systems < WEIGHTS.SCORE_MIN_HOP1_PLANET_SYS:
+                    _score += -100
  
 
-        return _score
+            self.cached_score = _score
+
+        return self.cached_score
 
     #
     # Return a score representing the difference between the statistics class and another class. 
@@ -340,7 +390,7 @@ class Home:
         self.index = index
         self.keegan = keegan
         self.coord = KEEGAN_TO_COORD[keegan]
-        self.dist_to = [cube_distance(self.coord,KEEGAN_TO_COORD[c]) for c in range(num_tiles)]
+        self.dist_to = DIST_MATRIX[keegan][:num_tiles]
 
         #
         # Keegan indicies of tiles that are 'h' hops away for 0,1 and 2 hops
@@ -355,15 +405,16 @@ class Home:
 
 
     #
-    # Calculate the keegan indicies of the 2-hop tiles dividing into contested and uncontested
+    # Calculate the keegan indicies of the 2-hop tiles dividing into contested and uncontested.
+    # "hop1_count" and "hop2_count" count how many home systems have each keegan index in their
+    # 1-hop and 2-hop lists.
     #
-    def initialize_hop2_tile_lists(self,all_homes):
-        other_hop1 = set()
-        other_hop2 = set()
-        for i in range(len(all_homes)):
-            if all_homes[i].index != self.index:
-                other_hop1 = other_hop1 | set(all_homes[i].hop[1])
-                other_hop2 = other_hop2 | set(all_homes[i].hop[2])
+    def initialize_hop2_tile_lists(self,hop1_count,hop2_count):
+        #
+        # Removing our own tiles from the counts leaves the tiles in another home system's lists
+        #
+        other_hop1 = hop1_count - collections.Counter(self.hop[1])
+        other_hop2 = hop2_count - collections.Counter(self.hop[2])
 
         #
         # Unconstested 2-hop tiles are those that are in our 2-hop list, but not in another home systems 1-hop or 2-hop lists
@@ -383,17 +434,28 @@ class Home:
         self.stats2c = HomeStats(2,"C")
         self.stats2t = HomeStats(2,"T")
 
+        #
+        # Combined list of (keegan index, statistics class) pairs for all classes so the
+        # statistics can be computed in a single pass.  2-hop tiles also count toward the
+        # 2-hop total class.
+        #
+        self.hop_slots = [(k,self.stats1) for k in self.hop[1]]
+        self.hop_slots += [pair for k in self.hop2u for pair in ((k,self.stats2u),(k,self.stats2t))]
+        self.hop_slots += [pair for k in self.hop2c for pair in ((k,self.stats2c),(k,self.stats2t))]
+
     #
-    # Reset all statistics values before recomputing
+    # Recompute all statistics from a list of tile numbers specifying the board
     #
     def update_stats(self,tiles):
-        self.stats1.update(self.hop[1],tiles)
-        self.stats2u.update(self.hop2u,tiles)
-        self.stats2c.update(self.hop2c,tiles)
-
+        self.stats1.reset()
+        self.stats2u.reset()
+        self.stats2c.reset()
         self.stats2t.reset()
-        self.stats2t += self.stats2u
-        self.stats2t += self.stats2c
+
+        for k,stats in self.hop_slots:
+            tile_index = tiles[k]
+            if not is_home(tile_index):
+                stats.add_tile(tile_index)
 
     #
     # Print a home system
@@ -456,6 +518,11 @@ class Board:
         #
         self.num_tiles = len(self.tiles)
 
+        #
+        # Adjacent keegan indices for each keegan index that are on this board
+        #
+        self.adjacent = [[k for k in KEEGAN_ADJACENT[keegan] if k < self.num_tiles] for keegan in range(self.num_tiles)]
+
         #
         # Initialize the home system stats
         #
@@ -466,9 +533,20 @@ class Board:
         #
         # Create the contested/unconstested keegan index lists for each home
         #
+        hop1_count = collections.Counter(k for home in self.homes for k in home.hop[1])
+        hop2_count = collections.Counter(k for home in self.homes for k in home.hop[2])
         for i in range(self.num_homes):
-            self.homes[i].initialize_hop2_tile_lists(self.homes)
+            self.homes[i].initialize_hop2_tile_lists(hop1_count,hop2_count)
 
+        #
+        # For each keegan index, list the (home index, statistics class) pairs whose
+        # statistics include the tile at that position.  This lets us update statistics
+        # incrementally when a tile is swapped instead of recomputing everything.
+        #
+        self.slot_stats = [[] for k in range(self.num_tiles)]
+        for h in range(self.num_homes):
+            for k,stats in self.homes[h].hop_slots:
+                self.slot_stats[k] += [(h,stats)]
 
         #
         # Build list of unused tiles
@@ -480,6 +558,11 @@ class Board:
         #
         self.update_stats()
 
+        #
+        # Cache of difference scores between each pair of home systems
+        #
+        self.update_pair_diffs()
+
     #############################################################################
     #
     # Generate a random board for n players
@@ -504,21 +587,16 @@ class Board:
         #
         num_tiles = 37 if n <= 6 else 61
 
-        #
-        # Get all (non-home) tiles (except first one which is Mecatol)
-        #
-        all_tiles = [i for i in NONHOME_TILES if i != MECATOL_INDEX]
-
         #
         # Always include Mecatol Rex and the required tiles
         #
         tile_list = [MECATOL_INDEX] + list(FLAGS.require)
 
         #
-        # Remove the required tiles from "all_tiles" since they have already been assigned
+        # Get all (non-home) tiles except Mecatol and the required tiles since they have
+        # already been assigned
         #
-        for r in FLAGS.require:
-            del all_tiles[all_tiles.index(r)]
+        all_tiles = [i for i in NONHOME_TILES if i != MECATOL_INDEX and i not in FLAGS.require]
 
         #
         # Randomize other tiles
@@ -526,12 +604,11 @@ class Board:
         tile_list += random.sample(all_tiles,num_tiles-len(tile_list)-n)
 
         #
-        # Insert the home systems
+        # Interleave the home systems in a single pass
         #
-        for k in home_keegan:
-            tile_list.insert(k,0)
-
-        return tile_list
+        home_set = set(home_keegan)
+        others = iter(tile_list)
+        return [0 if k in home_set else next(others) for k in range(num_tiles)]
 
     #
     # Generate a url for the current board state
@@ -552,7 +629,8 @@ class Board:
     # Update list of unused tiles
     #
     def update_unused(self):
-        self.unused = [tile for tile in NONHOME_TILES if tile not in self.tiles and tile not in FLAGS.exclude]
+        in_use = set(self.tiles)
+        self.unused = [tile for tile in NONHOME_TILES if tile not in in_use and tile not in FLAGS.exclude]
 
     #
     # Update statistics for all home systems
@@ -561,6 +639,53 @@ class Board:
         for h in range(len(self.homes)):
             self.homes[h].update_stats(self.tiles)
 
+    #
+    # Incrementally update statistics for replacing "old_tile" with "new_tile" at a keegan
+    # index.  Both tiles must be non-home tiles.
+    #
+    def update_slot_stats(self,keegan,old_tile,new_tile):
+        for h,stats in self.slot_stats[keegan]:
+            stats.sub_tile(old_tile)
+            stats.add_tile(new_tile)
+
+    #
+    # Place "new_tiles" at the keegan indices "keegan_list", where the statistics currently
+    # reflect "old_tiles" at those positions, and update the statistics and difference scores.
+    #
+    def place_tiles(self,keegan_list,old_tiles,new_tiles):
+        touched = set()
+        for i in range(len(keegan_list)):
+            self.tiles[keegan_list[i]] = new_tiles[i]
+            if old_tiles[i] != new_tiles[i]:
+                self.update_slot_stats(keegan_list[i],old_tiles[i],new_tiles[i])
+                touched.update(h for h,stats in self.slot_stats[keegan_list[i]])
+
+        for h in touched:
+            self.recompute_pair_diffs(h)
+
+    #
+    # Recompute the difference scores between all pairs of home systems.  pair_diffs[i][j]
+    # and pair_diffs[j][i] both hold the difference of home min(i,j) against home max(i,j).
+    #
+    def update_pair_diffs(self):
+        self.pair_diffs = [[0]*self.num_homes for h in range(self.num_homes)]
+        for h in range(self.num_homes):
+            self.recompute_pair_diffs(h)
+
+    #
+    # Recompute the difference scores between home system "h" and all other home systems
+    #
+    def recompute_pair_diffs(self,h):
+        for j in range(self.num_homes):
+            if j < h:
+                diff = self.homes[j].difference(self.homes[h])
+            elif j > h:
+                diff = self.homes[h].difference(self.homes[j])
+            else:
+                continue
+            self.pair_diffs[h][j] = diff
+            self.pair_diffs[j][h] = diff
+
     #
     # Print statistic summary of board
     #
@@ -584,146 +709,330 @@ class Board:
         return max_diff
 
     #
-    # Optimize the current board state by trying to improve it over a specified number of steps
+    # Get the imbalance from the cached difference scores, returning early with a value of at
+    # least "upper" as soon as any pair reaches it.  "fixed" is the largest difference between
+    # home systems not in "homes".  Difference scores for home systems in "dirty" are recomputed
+    # first since they are the most likely to exceed the bound, and are removed from "dirty"
+    # once their row is complete.
+    #
+    def get_imbalance_bounded(self,upper,fixed,homes,dirty):
+        max_diff = fixed
+        done = set()
+        for h in [h for h in homes if h in dirty] + [h for h in homes if h not in dirty]:
+            if h in dirty:
+                for j in range(self.num_homes):
+                    if j == h or j in done:
+                        continue
+                    if j < h:
+                        diff = self.homes[j].difference(self.homes[h])
+                    else:
+                        diff = self.homes[h].difference(self.homes[j])
+                    self.pair_diffs[h][j] = diff
+                    self.pair_diffs[j][h] = diff
+                    if diff >= upper:
+                        return diff
+                    if diff > max_diff:
+                        max_diff = diff
+                dirty.discard(h)
+            else:
+                diff = max(self.pair_diffs[h])
+                if diff >= upper:
+                    return diff
+                if diff > max_diff:
+                    max_diff = diff
+            done.add(h)
+
+        return max_diff
+
+    #
+    # Optimize the current board state by trying to improve it over a specified number of steps.
+    # This uses simulated annealing: a worse board may be accepted with a probability that
+    # shrinks as the temperature cools geometrically from "temperature" to "min_temperature".
+    # A temperature of 0 only accepts improvements.  The best board seen is kept at the end.
     #
-    def optimize(self, steps):
-        for i in range(steps):
-            imbalance = board.get_imbalance()
-            print("{}:imbalance={}".format(i,imbalance))
-            if imbalance == 0:
-                return 0
-            board.improve()
-        return board.get_imbalance()
+    def optimize(self, steps, temperature=5.0, min_temperature=0.01):
+        #
+        # Cooling factor per step.  A temperature already at or below the minimum is held
+        # constant rather than raised toward it.
+        #
+        if steps > 0 and temperature > min_temperature:
+            cooling = (min_temperature/temperature)**(1/steps)
+        else:
+            cooling = 1
+
+        best_imbalance = self.get_imbalance()
+        best_board = list(self.tiles)
+
+        #
+        # Start the worker processes once for all steps
+        #
+        executor = None
+        if FLAGS.jobs > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(FLAGS.jobs,initializer=init_worker,initargs=(FLAGS,))
+
+        try:
+            for i in range(steps):
+                imbalance = self.get_imbalance()
+                print("{}:imbalance={}".format(i,imbalance))
+                if imbalance < best_imbalance:
+                    best_imbalance = imbalance
+                    best_board = list(self.tiles)
+                if imbalance == 0:
+                    break
+                self.improve(executor,temperature)
+                temperature *= cooling
+        finally:
+            if executor:
+                executor.shutdown()
+
+        #
+        # Go back to the best board if we moved away from it
+        #
+        if self.get_imbalance() > best_imbalance:
+            self.tiles = best_board
+            self.update_unused()
+
+        #
+        # Statistics are updated incrementally while optimizing, which leaves the skip lists
+        # out of board order.  Rebuild them once so they print the same as a fresh board.
+        #
+        self.update_stats()
+        self.update_pair_diffs()
+
+        return self.get_imbalance()
 
     #
     # Check a set of tiles (by keegan index) for validity
     #
     def is_valid(self,keegan):
-        tile = TILES[self.tiles[keegan]]
+        tiles = self.tiles
+        tile = tiles[keegan]
+        adjacent = self.adjacent[keegan]
 
         #
         # No adjacent anomalies
         #
-        if tile['anomaly']:
-            if any(self.tiles[k] > 0 and TILES[self.tiles[k]]['anomaly'] != None for k in KEEGAN_ADJACENT[keegan] if k < self.num_tiles):
+        if TILE_ANOMALY[tile]:
+            if any(tiles[k] > 0 and TILE_ANOMALY[tiles[k]] for k in adjacent):
                 return False
 
         #
-        # No adjacent wormholes of same type
+        # No adjacent wormholes of same type, and no wormholes adjacent to a player
         #
-        if tile['worm']:
-            if any(self.tiles[k] > 0 and tile['worm'] == TILES[self.tiles[k]]['worm'] for k in KEEGAN_ADJACENT[keegan] if k < self.num_tiles):
+        worm = TILE_WORM[tile]
+        if worm:
+            if any(tiles[k] == 0 or (tiles[k] > 0 and TILE_WORM[tiles[k]] == worm) for k in adjacent):
                 return False
 
         #
         # No legandary planets adjacent to a player
         #
-        if tile['skip'] == 'legend':
-            if any(self.tiles[k] == 0 for k in KEEGAN_ADJACENT[keegan] if k < self.num_tiles):
-                return False
-
-        #
-        # No wormholes adjacent to a player
-        #
-        if tile['worm']:
-            if any(self.tiles[k] == 0 for k in KEEGAN_ADJACENT[keegan] if k < self.num_tiles):
+        if TILE_LEGEND[tile]:
+            if any(tiles[k] == 0 for k in adjacent):
                 return False
            
         return True
 
     #
-    # Try to improve a board
+    # Try to improve a board.  If "executor" is given, the permutation search is split
+    # across its worker processes.  With a "temperature" above 0, a worse arrangement is
+    # accepted with the Metropolis probability exp(-(new-current)/temperature).
     #
-    def improve(self):
+    def improve(self,executor=None,temperature=0.0):
+        #
+        # Keegan indices that may be shuffled.  Home tiles and positions with locked tiles
+        # are never shuffled.
+        #
+        allowed = [k for k in range(1,self.num_tiles) if not TILE_HOME[self.tiles[k]] and not (FLAGS.lock and self.tiles[k] in FLAGS.lock)]
+
         #
         # choose num_shuffle tiles to use for shuffling
         #
-        shuffle_keegan = []
-        for i in range(FLAGS.shuffle):
-            while True:
-                keegan = random.randint(1,self.num_tiles-1)
+        shuffle_keegan = random.sample(allowed,FLAGS.shuffle)
 
-                #
-                # We already picked this position
-                #
-                if keegan in shuffle_keegan:
-                    continue
+        #
+        # List of free tiles to try in the keegan indices in the shuffle set.  This includes
+        # the tiles that we just "lifted" from the shuffle_keegan set, and all the currently
+        # free tiles.
+        #
+        free_tiles = [self.tiles[i] for i in shuffle_keegan] + self.unused
+        current_tiles = [self.tiles[k] for k in shuffle_keegan]
 
-                #
-                # Don't shuffle home tiles
-                #
-                if is_home(self.tiles[keegan]):
-                    continue
+        #
+        # For each shuffle position, find the free tiles that can be placed there without
+        # conflicting with the surrounding tiles that are not being shuffled.  The other
+        # shuffle positions are marked empty (-1) while checking.  A tile that doesn't fit
+        # here makes every permutation that puts it here invalid, so those are never tried.
+        #
+        for k in shuffle_keegan:
+            self.tiles[k] = -1
+
+        fits = []
+        for k in shuffle_keegan:
+            fit = []
+            for tile in free_tiles:
+                self.tiles[k] = tile
+                if self.is_valid(k):
+                    fit += [tile]
+            self.tiles[k] = -1
+            fits += [fit]
 
-                #
-                # Don't shuffle positions with locked tiles
-                #
-                if FLAGS.lock and self.tiles[keegan] in FLAGS.lock:
-                    continue
+        for i in range(FLAGS.shuffle):
+            self.tiles[shuffle_keegan[i]] = current_tiles[i]
 
-                #
-                # Everything looks good.
-                #
-                break
+        #
+        # Only accept arrangements with an imbalance below "threshold".  Drawing the Metropolis
+        # random number up front turns the acceptance test into this threshold, so the best
+        # arrangement found is accepted exactly when it passes the test.
+        #
+        threshold = max(map(max,self.pair_diffs))
+        if temperature > 0:
+            threshold -= temperature*math.log(1.0-random.random())
 
-            #
-            # Add to tile positions to be shuffled
-            #
-            shuffle_keegan += [keegan]
+        #
+        # Search for the best permutation.  In parallel, each worker searches the permutations
+        # starting with a contiguous block of the tiles for the first position.  Taking the
+        # first of the best results keeps the same answer as a serial search.
+        #
+        if executor:
+            num_blocks = 4*FLAGS.jobs
+            blocks = [fits[0][b*len(fits[0])//num_blocks:(b+1)*len(fits[0])//num_blocks] for b in range(num_blocks)]
+            results = executor.map(search_worker,itertools.repeat(self),itertools.repeat(shuffle_keegan),
+                                   [[block]+fits[1:] for block in blocks if block],itertools.repeat(threshold))
+            best_imbalance,best_tiles = min(results,key=lambda result: result[0],default=(threshold,current_tiles))
+        else:
+            best_imbalance,best_tiles = self.search(shuffle_keegan,fits,threshold)
 
         #
-        # List of free tiles to try in the keegan indices in the shuffle set.  This includes
-        # the tiles that we just "lifted" from the shuffle_keegan set, and all the currently
-        # free tiles.
+        # Insert the best tiles we found back into the map
         #
-        free_tiles = [self.tiles[i] for i in shuffle_keegan] + self.unused
+        self.place_tiles(shuffle_keegan,current_tiles,best_tiles)
 
         #
-        # Get current imbalance and tiles
+        # The statistics were kept up to date while searching, so only the unused tile list
+        # needs updating, and only if the board changed
         #
-        best_imbalance = self.get_imbalance()
+        if best_tiles != current_tiles:
+            self.update_unused()
+
+    #
+    # Search the permutations of tiles for the shuffle positions, choosing the tile at each
+    # position from "fits".  Returns the best imbalance below "threshold" and its tiles, or
+    # "threshold" and the current tiles if there is none.  The board is left unchanged.
+    #
+    def search(self,shuffle_keegan,fits,threshold):
+        #
+        # Get threshold and current tiles.  "best_tiles" is reused for each new best permutation
+        # rather than reallocated.
+        #
+        best_imbalance = threshold
         best_tiles = [self.tiles[shuffle_keegan[i]] for i in range(FLAGS.shuffle)]
 
         #
-        # Iterate through all permutations of num_shuffle tiles in the free tiles set.
+        # Tiles that the home statistics currently reflect at each shuffle position
+        #
+        placed = list(best_tiles)
+
+        #
+        # Home systems whose statistics can change in this search.  The largest difference
+        # between two other home systems is fixed, so if it already reaches the threshold no
+        # permutation can get below it.
+        #
+        affected = sorted(set(h for k in shuffle_keegan for h,stats in self.slot_stats[k]))
+        fixed = max([self.pair_diffs[i][j] for i,j in itertools.combinations(range(self.num_homes),2)
+                     if i not in affected and j not in affected],default=0)
+        if fixed >= best_imbalance:
+            return best_imbalance,best_tiles
+
+        #
+        # Home systems whose statistics changed since their difference scores were computed
+        #
+        dirty = set()
+
+        #
+        # This loop runs for every permutation, so look up everything it uses once up front
+        #
+        board_tiles = self.tiles
+        is_valid = self.is_valid
+        update_slot_stats = self.update_slot_stats
+        get_imbalance_bounded = self.get_imbalance_bounded
+        num_shuffle = FLAGS.shuffle
+        positions = range(num_shuffle)
+        slot_homes = [[h for h,stats in self.slot_stats[k]] for k in shuffle_keegan]
+
+        #
+        # Iterate through all permutations of num_shuffle tiles in the free tiles set, built
+        # from the tiles that fit at each position.  The current arrangement can't beat itself,
+        # so skip it.
         #
-        for tiles in itertools.permutations(free_tiles,FLAGS.shuffle):
-            for i in range(FLAGS.shuffle):
-                self.tiles[shuffle_keegan[i]] = tiles[i]
+        current_tiles = tuple(best_tiles)
+        for tiles in itertools.product(*fits):
+            if tiles == current_tiles or len(set(tiles)) < num_shuffle:
+                continue
 
+            for i in positions:
+                board_tiles[shuffle_keegan[i]] = tiles[i]
 
             #
             # Check validity of all tiles we want to place.  Skip this permutation
             # if there is an invalid tile placement.
             #
-            if not all(self.is_valid(shuffle_keegan[i]) for i in range(FLAGS.shuffle)):
+            valid = True
+            for k in shuffle_keegan:
+                if not is_valid(k):
+                    valid = False
+                    break
+            if not valid:
                 continue
 
             #
-            # Update statistics in new board
+            # Update statistics in new board by only applying the changes at the
+            # shuffled positions
             #
-            self.update_stats()
+            for i in positions:
+                tile = tiles[i]
+                if placed[i] != tile:
+                    update_slot_stats(shuffle_keegan[i],placed[i],tile)
+                    dirty.update(slot_homes[i])
+                    placed[i] = tile
 
             #
-            # Calculate the current imbalance.  Update the best imbalance the best tile
-            # permutation if it is the best we have seen so far.
+            # Calculate the current imbalance, stopping as soon as it can't beat the best.
+            # Update the best imbalance the best tile permutation if it is the best we have
+            # seen so far.
             #
-            imbalance = self.get_imbalance()
+            imbalance = get_imbalance_bounded(best_imbalance,fixed,affected,dirty)
             if imbalance < best_imbalance:
                 best_imbalance = imbalance
-                best_tiles = [self.tiles[shuffle_keegan[i]] for i in range(FLAGS.shuffle)]
+                best_tiles[:] = tiles
 
         #
-        # Insert the best tiles we found back into the map
+        # Put the original tiles back and refresh any difference scores left out of date
         #
-        for i in range(FLAGS.shuffle):
-            self.tiles[shuffle_keegan[i]] = best_tiles[i]
+        self.place_tiles(shuffle_keegan,placed,current_tiles)
+        for h in dirty:
+            self.recompute_pair_diffs(h)
 
-        #
-        # Update the unused tile list
-        #
-        self.update_stats()
-        self.update_unused()
+        return best_imbalance,best_tiles
+
+########################################################################################
+#
+# Set up a worker process for parallel optimization
+#
+def init_worker(flags):
+    global FLAGS
+    FLAGS = flags
+
+    if not TILES:
+        init_hex_coords()
+        load_tiles()
+
+########################################################################################
+#
+# Run a permutation search on a copy of a board in a worker process
+#
+def search_worker(board,shuffle_keegan,fits,threshold):
+    return board.search(shuffle_keegan,fits,threshold)
 
 ########################################################################################
 #
@@ -781,7 +1090,7 @@ def cube_ring(n):
 # Initialize the mapping from a keegan index to its cubic coordinate
 #
 def init_hex_coords():
-    global COORD_TO_KEEGAN, KEEGAN_TO_COORD, KEEGAN_ADJACENT
+    global COORD_TO_KEEGAN, KEEGAN_TO_COORD, KEEGAN_ADJACENT, DIST_MATRIX
 
     #
     # Create mapping from keegan index to hex coodinate
@@ -805,6 +1114,11 @@ def init_hex_coords():
                 adjacent += [COORD_TO_KEEGAN[n_coord]]
                 
         KEEGAN_ADJACENT += [adjacent]
+
+    #
+    # Precompute distances between all tiles since the coordinates never change
+    #
+    DIST_MATRIX = [[cube_distance(x,y) for y in KEEGAN_TO_COORD] for x in KEEGAN_TO_COORD]
                 
 #########################################################################################
 #
@@ -866,7 +1180,8 @@ def load_tiles():
             if index in TILES:
                 tile = TILES[index]
             else:
-                tile = {'resource':0,'influence':0,'skip':None, 'anomaly':None, 'worm':None, 'planets':[]}
+                tile = {'resource':0,'influence':0,'eff_resource':0,'eff_influence':0,'eff_both':0,
+                        'skip':None, 'anomaly':None, 'worm':None, 'planets':[]}
                 if is_home:
                     HOME_TILES += [index]
                     tile['home'] = planet['skip']
@@ -883,6 +1198,16 @@ def load_tiles():
             tile['resource'] += planet['resource']
             tile['influence'] += planet['influence']
 
+            #
+            # Effective resource/influence.  Planets with r=i count toward "both".
+            #
+            if planet['resource'] > planet['influence']:
+                tile['eff_resource'] += planet['resource']
+            elif planet['resource'] < planet['influence']:
+                tile['eff_influence'] += planet['influence']
+            else:
+                tile['eff_both'] += planet['resource']
+
 
             #
             # Ignore these fields for home systems
@@ -892,6 +1217,59 @@ def load_tiles():
                 tile['anomaly'] = planet['anomaly'] if planet['anomaly'] != '' else tile['anomaly']
                 tile['worm'] = planet['worm'] if planet['worm'] != '' else tile['worm']
 
+    init_tile_tables()
+
+########################################################################################
+#
+# Build the flat per-tile attribute tables from the loaded tiles.  TILES is kept for
+# reference, but the optimization loop only reads these tables.
+#
+def init_tile_tables():
+    global TILE_RESOURCE, TILE_INFLUENCE, TILE_EFF_RESOURCE, TILE_EFF_INFLUENCE, TILE_EFF_BOTH
+    global TILE_PLANET_SYSTEM, TILE_SKIP, TILE_ANOMALY, TILE_WORM, TILE_LEGEND, TILE_HOME
+
+    size = max(TILES)+1
+    TILE_RESOURCE = [0]*size
+    TILE_INFLUENCE = [0]*size
+    TILE_EFF_RESOURCE = [0]*size
+    TILE_EFF_INFLUENCE = [0]*size
+    TILE_EFF_BOTH = [0]*size
+    TILE_PLANET_SYSTEM = [False]*size
+    TILE_SKIP = [0]*size
+    TILE_ANOMALY = [0]*size
+    TILE_WORM = [0]*size
+    TILE_LEGEND = [False]*size
+    TILE_HOME = [False]*size
+    TILE_HOME[0] = True
+
+    for index,tile in TILES.items():
+        TILE_RESOURCE[index] = tile['resource']
+        TILE_INFLUENCE[index] = tile['influence']
+        TILE_EFF_RESOURCE[index] = tile['eff_resource']
+        TILE_EFF_INFLUENCE[index] = tile['eff_influence']
+        TILE_EFF_BOTH[index] = tile['eff_both']
+        TILE_PLANET_SYSTEM[index] = (tile['resource']+tile['influence']) > 0
+        TILE_SKIP[index] = to_id(SKIP_IDS,SKIP_NAMES,tile['skip'])
+        TILE_ANOMALY[index] = to_id(ANOMALY_IDS,ANOMALY_NAMES,tile['anomaly'])
+        TILE_WORM[index] = to_id(WORM_IDS,WORM_NAMES,tile['worm'])
+        TILE_LEGEND[index] = tile['skip'] == 'legend'
+        TILE_HOME[index] = tile['home'] != None
+
+########################################################################################
+#
+# Get the integer ID for a string attribute value, assigning the next ID if it is new.
+# Empty values get ID 0.
+#
+def to_id(ids,names,value):
+    if not value:
+        return 0
+
+    if value not in ids:
+        ids[value] = len(names)
+        names += [value]
+
+    return ids[value]
+
 ########################################################################################
 #
 # Tile analysis main function
@@ -921,7 +1299,7 @@ def main_board():
     # Do the optimization if the --optimize flag was used
     #
     if FLAGS.optimize:
-        board.optimize(FLAGS.rounds)
+        board.optimize(FLAGS.rounds,FLAGS.temperature)
 
     #
     # Show statistics
@@ -971,6 +1349,8 @@ if __name__ == "__main__":
     parser.add_argument('--require',type=str,default=None,help="tiles to require on map")
     parser.add_argument('--lock',type=str,default=None,help="lock tiles in place on map")
     parser.add_argument('--exclude',type=str,default=None,help="tiles to exclude from map")
+    parser.add_argument('--temperature',type=float,default=5.0,help="Starting simulated annealing temperature")
+    parser.add_argument('--jobs',type=int,default=1,help="Number of worker processes to use for optimization")
 
     parser.add_argument('names',type=str,nargs='*',default=None,help="List of player names")
 